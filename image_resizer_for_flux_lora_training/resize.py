@@ -1,12 +1,36 @@
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from PIL import Image
 import os
 import argparse
+import atexit
+import gc
+from functools import lru_cache
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Protocol
+from typing import FrozenSet, List, Optional, Tuple, Protocol
 from enum import IntEnum
-import multiprocessing
-from functools import partial
+import io
+import math
+import queue
+import threading
+
+try:
+    from cykooz_resizer import CropBox, FilterType, ResizeAlg, Resizer, ResizeOptions
+except ImportError:
+    Resizer = None
+
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+    # decode() allocates its own handle per call, so one instance is shared by all worker threads
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbojpeg = None
+
+IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg'})
+OUTPUT_SIZE = 512
+PNG_COMPRESS_LEVEL = 1
+# JPEGs are DCT-scaled on decode, keeping the short side at least this large for resize quality
+DRAFT_MIN_SIDE = 2 * OUTPUT_SIZE
 
 def setup_logger() -> logging.Logger:
     logger = logging.getLogger('ImageResizer')
@@ -14,12 +38,19 @@ def setup_logger() -> logging.Logger:
     handler = logging.StreamHandler()
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    # Worker threads only enqueue records; a listener thread does the stderr writes
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(QueueHandler(log_queue))
     return logger
 
 class FileSystem(Protocol):
     def list_directory(self, path: str) -> List[str]:
         ...
+    def list_files(self, path: str, extensions: FrozenSet[str]) -> List[str]:
+        ...
     def join_paths(self, *paths: str) -> str:
         ...
     def get_basename(self, path: str) -> str:
@@ -28,6 +59,10 @@ class FileSystem(Protocol):
         ...
     def makedirs(self, path: str) -> None:
         ...
+    def read_bytes(self, path: str) -> bytes:
+        ...
+    def write_bytes(self, path: str, data: bytes) -> None:
+        ...
     def getcwd(self) -> str:
         ...
 
@@ -35,6 +70,12 @@ class FileSystemImpl:
     def list_directory(self, path: str) -> List[str]:
         return os.listdir(path)
 
+    def list_files(self, path: str, extensions: FrozenSet[str]) -> List[str]:
+        # scandir's DirEntry caches the file type, avoiding a stat per entry
+        with os.scandir(path) as entries:
+            return [entry.path for entry in entries
+                    if entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions]
+
     def join_paths(self, *paths: str) -> str:
         return os.path.join(*paths)
 
@@ -47,6 +88,14 @@ class FileSystemImpl:
     def makedirs(self, path: str) -> None:
         os.makedirs(path, exist_ok=True)
 
+    def read_bytes(self, path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def write_bytes(self, path: str, data: bytes) -> None:
+        with open(path, 'wb') as f:
+            f.write(data)
+
     def getcwd(self) -> str:
         return os.getcwd()
 
@@ -55,84 +104,210 @@ class Mode(IntEnum):
     NON_CENTER = 2
     ALL = 3
 
+# Which of the (start, center, end) crops each mode keeps
+_MODE_CROPS = {
+    Mode.CENTER_ONLY: (1,),
+    Mode.NON_CENTER: (0, 2),
+    Mode.ALL: (0, 1, 2),
+}
+_VERTICAL_SUFFIXES = ('_S', '_C', '_E')
+_HORIZONTAL_SUFFIXES = ('_L', '_C', '_R')
+
+# (source box, suffix) for each crop of an image
+CropLayout = Tuple[Tuple[Tuple[int, int, int, int], str], ...]
+
+# Batches usually share a handful of source sizes, so the geometry is computed once per size
+@lru_cache(maxsize=256)
+def _crop_layout(w: int, h: int, mode: Mode) -> CropLayout:
+    # Square crops along the long axis; the short side is the crop size
+    vertical = h > w
+    side, long_side = (w, h) if vertical else (h, w)
+    offsets = (0, (long_side - side) // 2, long_side - side)
+    suffixes = _VERTICAL_SUFFIXES if vertical else _HORIZONTAL_SUFFIXES
+
+    if vertical:
+        return tuple(((0, offsets[i], w, offsets[i] + side), suffixes[i]) for i in _MODE_CROPS[mode])
+    return tuple(((offsets[i], 0, offsets[i] + side, h), suffixes[i]) for i in _MODE_CROPS[mode])
+
 class ImageProcessor:
     def __init__(self, fs: FileSystem):
         self.fs = fs
         self.logger = logging.getLogger('ImageResizer')
+        # Created lazily so each worker thread gets its own stateful resizer
+        self._resizer = None
+        self._resize_options = None
+        self._dst_image = None
 
-    def crop_vertical(self, img: Image.Image, target_ratio: float, mode: Mode = Mode.ALL) -> Tuple[List[Image.Image], List[str]]:
-        w, h = img.size
-        self.logger.info(f"Performing vertical crop on image of size {w}x{h}")
-        new_height = int(w / target_ratio)
-        all_crops = [
-            img.crop((0, 0, w, new_height)),
-            img.crop((0, (h - new_height) // 2, w, (h - new_height) // 2 + new_height)),
-            img.crop((0, h - new_height, w, h))
-        ]
-        all_suffixes = ['_S', '_C', '_E']
-
-        if mode == Mode.CENTER_ONLY:
-            return [all_crops[1]], [all_suffixes[1]]
-        elif mode == Mode.NON_CENTER:
-            return [all_crops[0], all_crops[2]], [all_suffixes[0], all_suffixes[2]]
-        return all_crops, all_suffixes
-
-    def crop_horizontal(self, img: Image.Image, target_ratio: float, mode: Mode = Mode.ALL) -> Tuple[List[Image.Image], List[str]]:
-        w, h = img.size
-        self.logger.info(f"Performing horizontal crop on image of size {w}x{h}")
-        new_width = int(h * target_ratio)
-        all_crops = [
-            img.crop((0, 0, new_width, h)),
-            img.crop(((w - new_width) // 2, 0, (w - new_width) // 2 + new_width, h)),
-            img.crop((w - new_width, 0, w, h))
-        ]
-        all_suffixes = ['_L', '_C', '_R']
-
-        if mode == Mode.CENTER_ONLY:
-            return [all_crops[1]], [all_suffixes[1]]
-        elif mode == Mode.NON_CENTER:
-            return [all_crops[0], all_crops[2]], [all_suffixes[0], all_suffixes[2]]
-        return all_crops, all_suffixes
-
-    def process_image(self, file_path: str, mode: Mode = Mode.ALL) -> None:
-        self.logger.info(f"Processing image: {file_path}")
-        img = Image.open(file_path)
-        w, h = img.size
-        target_ratio = 1.0
+    def resize(self, img: Image.Image, size: Tuple[int, int],
+               box: Optional[Tuple[int, int, int, int]] = None) -> Image.Image:
+        # `box` resizes only that region of `img`, fusing the crop into the resize pass
+        if Resizer is None:
+            return img.resize(size, Image.LANCZOS, box=box)
 
-        crops, suffixes = (self.crop_vertical(img, target_ratio, mode) if h > w
-                         else self.crop_horizontal(img, target_ratio, mode))
+        if self._resizer is None:
+            self._resizer = Resizer()
+            self._resize_options = ResizeOptions(resize_alg=ResizeAlg.convolution(FilterType.lanczos3))
+        if self._dst_image is None or self._dst_image.size != size:
+            self._dst_image = Image.new('RGB', size)
+        options = self._resize_options
+        if box is not None:
+            options = options.copy()
+            options.crop_box = CropBox(box[0], box[1], box[2] - box[0], box[3] - box[1])
+        self._resizer.resize_pil(img, self._dst_image, options)
+        return self._dst_image
 
-        # Simplified output directory - just use the parent directory of the input file
-        output_dir = self.fs.join_paths(os.path.dirname(file_path), '..')
-        self.fs.makedirs(output_dir)
+    def _crop_boxes(self, w: int, h: int, mode: Mode = Mode.ALL) -> CropLayout:
+        self.logger.debug('Performing %s crop on image of size %dx%d', 'vertical' if h > w else 'horizontal', w, h)
+        return _crop_layout(w, h, mode)
+
+    def _decode_turbojpeg(self, data: bytes) -> Image.Image:
+        w, h, _, _ = _turbojpeg.decode_header(data)
+        # Smallest downscaling factor that keeps the short side at DRAFT_MIN_SIDE, as draft() does
+        scaling_factor = min((f for f in _turbojpeg.scaling_factors
+                              if f[0] <= f[1] and min(w, h) * f[0] >= DRAFT_MIN_SIDE * f[1]),
+                             key=lambda f: f[0] / f[1], default=None)
+        return Image.fromarray(_turbojpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=scaling_factor))
+
+    def decode_image(self, data: bytes) -> Image.Image:
+        if _turbojpeg is not None and data[:3] == b'\xff\xd8\xff':
+            try:
+                return self._decode_turbojpeg(data)
+            except OSError as e:
+                # e.g. CMYK JPEGs, which libjpeg-turbo cannot decode to RGB; Pillow handles them
+                self.logger.debug('TurboJPEG decode failed, falling back to Pillow: %s', e)
+
+        img = Image.open(io.BytesIO(data))
+        if img.format == 'JPEG':
+            w, h = img.size
+            scale = DRAFT_MIN_SIDE / min(w, h)
+            if scale < 1:
+                img.draft('RGB', (math.ceil(w * scale), math.ceil(h * scale)))
+        img.load()
+        if img.mode != 'RGB':
+            # Outputs are opaque RGB anyway; converting up front keeps palette, alpha and grayscale
+            # sources on the packed 24-bit resize paths (Pillow falls back to NEAREST for 'P')
+            rgb = img.convert('RGB')
+            img.close()
+            img = rgb
+        return img
+
+    def render_image(self, img: Image.Image, file_path: str, output_dir: str,
+                     mode: Mode = Mode.ALL) -> List[Tuple[str, bytes]]:
+        self.logger.info('Processing image: %s', file_path)
+        w, h = img.size
+        boxes = self._crop_boxes(w, h, mode)
 
         base_filename, _ = self.fs.split_ext(self.fs.get_basename(file_path))
+        # Join once per file; each crop only appends its suffix
+        output_prefix = self.fs.join_paths(output_dir, base_filename)
+
+        outputs = []
+        for box, suffix in boxes:
+            # Crops are square, so resizing straight from the source region fills the output
+            # without a letterbox and without copying out an intermediate crop
+            resized = self.resize(img, (OUTPUT_SIZE, OUTPUT_SIZE), box)
+
+            # Encode here, while the resizer's reused destination image still holds this crop
+            buffer = io.BytesIO()
+            # Fast zlib level: outputs are training data that get re-read, not archived
+            resized.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+            if resized is not self._dst_image:
+                resized.close()
+            output_path = output_prefix + suffix + '.png'
+            outputs.append((output_path, buffer.getvalue()))
+        return outputs
+
+    def process_image(self, data: bytes, file_path: str, output_dir: str,
+                      mode: Mode = Mode.ALL) -> List[Tuple[str, bytes]]:
+        # Closing releases Pillow's pixel buffer now rather than whenever GC gets to it
+        with self.decode_image(data) as img:
+            return self.render_image(img, file_path, output_dir, mode)
 
-        for crop, suffix in zip(crops, suffixes):
-            max_dim = max(crop.size)
-            square = Image.new('RGB', (max_dim, max_dim), 'black')
-            square.paste(crop, ((max_dim - crop.size[0]) // 2, (max_dim - crop.size[1]) // 2))
-            resized = square.resize((512, 512))
+# Reader -> workers -> writer, connected by bounded queues and shut down with None sentinels.
+# The reader and writer threads only do disk I/O, so reads and writes overlap with the
+# decode/crop/resize/encode work done by the worker threads.
+def run_pipeline(work_items: List[Tuple[str, Mode, str]], fs: FileSystem, processors: List[ImageProcessor]) -> None:
+    workers = len(processors)
+    logger = logging.getLogger('ImageResizer')
+    read_queue: queue.Queue = queue.Queue(maxsize=2 * workers)
+    write_queue: queue.Queue = queue.Queue(maxsize=2 * workers)
+    # Set on Ctrl-C: stages keep draining their queues until the sentinels arrive but do no more work
+    stop = threading.Event()
+
+    def reader() -> None:
+        try:
+            for file_path, mode, output_dir in work_items:
+                if stop.is_set():
+                    break
+                try:
+                    read_queue.put((file_path, mode, output_dir, fs.read_bytes(file_path)))
+                except Exception as e:
+                    logger.error('Error reading %s: %s', file_path, e)
+        finally:
+            for _ in range(workers):
+                read_queue.put(None)
+
+    def worker(processor: ImageProcessor) -> None:
+        while (item := read_queue.get()) is not None:
+            if stop.is_set():
+                continue
+            file_path, mode, output_dir, data = item
+            try:
+                outputs = processor.process_image(data, file_path, output_dir, mode)
+                # Hand over all crops of a file at once: one queue round-trip per file
+                write_queue.put(outputs)
+            except Exception as e:
+                logger.error('Error processing %s: %s', file_path, e)
+
+    def writer() -> None:
+        while (outputs := write_queue.get()) is not None:
+            if stop.is_set():
+                continue
+            for output_path, data in outputs:
+                try:
+                    fs.write_bytes(output_path, data)
+                    logger.debug('Saved processed image to: %s', output_path)
+                except Exception as e:
+                    logger.error('Error writing %s: %s', output_path, e)
 
-            output_path = self.fs.join_paths(output_dir, f"{base_filename}{suffix}.png")
-            resized.save(output_path)
-            self.logger.debug(f"Saved processed image to: {output_path}")
+    reader_thread = threading.Thread(target=reader)
+    worker_threads = [threading.Thread(target=worker, args=(p,)) for p in processors]
+    writer_thread = threading.Thread(target=writer)
+
+    reader_thread.start()
+    for t in worker_threads:
+        t.start()
+    writer_thread.start()
 
-def process_image_worker(file_info: Tuple[str, Mode], fs: FileSystem) -> None:
-    file_path, mode = file_info
     try:
-        processor = ImageProcessor(fs)
-        processor.process_image(file_path, mode)
-    except Exception as e:
-        logging.error(f"Error processing {file_path}: {str(e)}")
+        reader_thread.join()
+        for t in worker_threads:
+            t.join()
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        # Always shut the writer down, even when interrupted, so no thread is left blocked on a queue
+        reader_thread.join()
+        for t in worker_threads:
+            t.join()
+        write_queue.put(None)
+        writer_thread.join()
+
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 def main():
     parser = argparse.ArgumentParser(description='Image cropping and resizing tool')
     parser.add_argument('mode', type=int, choices=[1, 2, 3],
                        help='1: Center only, 2: Non-center, 3: All crops')
-    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
-                       help='Number of worker processes')
+    parser.add_argument('--workers', type=positive_int, default=os.cpu_count() or 1,
+                       help='Number of worker threads')
+    parser.add_argument('--chunk-size', type=positive_int, default=None,
+                       help='Number of images processed per pass, bounding peak memory (default: all)')
     args = parser.parse_args()
 
     logger = setup_logger()
@@ -146,16 +321,19 @@ def main():
     logger.info(f"Processing images from directory: {input_dir}")
 
     # Prepare work items
-    work_items = []
-    for filename in fs.list_directory(input_dir):
-        if filename.endswith(('.png', '.jpg')):
-            file_path = fs.join_paths(input_dir, filename)
-            work_items.append((file_path, mode))
-
-    # Process images in parallel
-    with multiprocessing.Pool(processes=args.workers) as pool:
-        worker_func = partial(process_image_worker, fs=fs)
-        pool.map(worker_func, work_items)
+    # Simplified output directory - just use the parent directory of the input directory
+    output_dir = os.path.dirname(input_dir)
+    fs.makedirs(output_dir)
+
+    work_items = [(file_path, mode, output_dir) for file_path in fs.list_files(input_dir, IMAGE_EXTENSIONS)]
+
+    # Process images in parallel; Pillow releases the GIL while decoding, resizing and encoding
+    # Processors are created once and reused across chunks, so per-worker state is set up only once
+    processors = [ImageProcessor(fs) for _ in range(args.workers)]
+    chunk_size = args.chunk_size if args.chunk_size is not None else max(len(work_items), 1)
+    for start in range(0, len(work_items), chunk_size):
+        run_pipeline(work_items[start:start + chunk_size], fs, processors)
+        gc.collect()
 
     logger.info("Image processing completed")
 